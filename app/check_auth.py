@@ -1,7 +1,7 @@
 from helpers.clientsession import get_client_session
 import logging
-import asyncio
 import helpers.directory as directory
+from helpers.profiling import run
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,4 +18,4 @@ async def main():
             f'Auth: \n{auth}')
 
 
-asyncio.run(main())
+run(main())
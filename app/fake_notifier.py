@@ -0,0 +1,45 @@
+import sys
+import logging
+import asyncio
+import aiohttp
+from dotenv import load_dotenv
+
+# must run before helpers.listener reads LISTEN_PORT and LISTEN_TOKEN
+load_dotenv()
+
+from helpers.listener import (  # noqa: E402
+    LISTEN_PORT, LISTEN_TOKEN, NOTIFY_PATH)
+from helpers.profiling import run  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Sends each pilgrim id given on the command line to a locally running
+# `sync_subscriptions.py listen` several times in quick succession, the way
+# the directory does when a pilgrim is edited repeatedly, so debouncing can
+# be checked without the directory: e.g. `python fake_notifier.py 12 34`
+REPEATS = 3
+INTERVAL_SECONDS = 0.5
+NOTIFY_URL = f'http://localhost:{LISTEN_PORT}{NOTIFY_PATH}'
+
+
+async def main():
+    # skip mode flags such as `profile`
+    pilgrim_ids = list(map(
+        int, filter(lambda arg: arg.isdigit(), sys.argv[1:])))
+    headers = {}
+    if(LISTEN_TOKEN):
+        headers['authorization'] = f'Bearer {LISTEN_TOKEN}'
+    async with aiohttp.ClientSession(raise_for_status=True) as session:
+        for attempt in range(REPEATS):
+            async with session.post(
+                    NOTIFY_URL,
+                    headers=headers,
+                    json={'pilgrim_ids': pilgrim_ids}) as resp:
+                logger.info(
+                    f'Notification {attempt+1} of {REPEATS}: '
+                    f'{await resp.json()}')
+            await asyncio.sleep(INTERVAL_SECONDS)
+
+
+run(main())
@@ -0,0 +1,44 @@
+import asyncio
+import json
+import logging
+from types import ModuleType
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Optional runtime accelerators, see requirements-accel.txt. Each falls
+# back to the standard library when it is not installed.
+orjson: Optional[ModuleType]
+uvloop: Optional[ModuleType]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+JSON_CODEC = 'orjson' if orjson else 'json'
+
+
+def json_dumps(obj):
+    """Serialize obj to a JSON str, for aiohttp's json_serialize and logs."""
+    if(orjson):
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+def json_loads(data):
+    """Deserialize a JSON str or bytes, for aiohttp's resp.json(loads=)."""
+    if(orjson):
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def install_event_loop_policy():
+    if(uvloop):
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info(
+        f'Using {"uvloop" if uvloop else "asyncio"} event loop '
+        f'and {JSON_CODEC} JSON codec')
@@ -0,0 +1,24 @@
+import os
+import time
+
+
+class RunBudget(object):
+    """Wall-clock budget for a single run. A budget of None never expires."""
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def expired(self, share=1.0):
+        """True once the given share of the budget has been used up."""
+        if(self.seconds is None):
+            return False
+        return self.elapsed() >= self.seconds * share
+
+
+def get_run_budget():
+    seconds = float(os.getenv('RUN_BUDGET_SECONDS', '0'))
+    return RunBudget(seconds if seconds > 0 else None)
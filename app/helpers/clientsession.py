@@ -10,6 +10,7 @@ from aiohttp import (
     ClientTimeout
 )
 from aiohttp_retry import RetryClient, ExponentialRetry  # type: ignore
+from helpers.accel import json_dumps
 
 logger = logging.getLogger(__name__)
 
@@ -49,4 +50,5 @@ def get_client_session(
             connector=connector,
             timeout=ClientTimeout(total=timeout),
             retry_options=retry_options,
+            json_serialize=json_dumps,
             trace_configs=[trace_config])
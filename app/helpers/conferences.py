@@ -0,0 +1,35 @@
+import re
+
+CONF_NEWSL_REGEX = re.compile(r'^(Piedmont|Western|Eastern) Conference$')
+
+
+def get_newsletter_ids_by_conf_name(newsletters):
+    newsletter_ids_by_conf_name = {}
+    for newsletter in newsletters:
+        results = CONF_NEWSL_REGEX.match(newsletter['newsletter_label'])
+        if(results):
+            newsletter_ids_by_conf_name[results.group(1)] = \
+                newsletter['newsletter_id']
+    return newsletter_ids_by_conf_name
+
+
+def get_conf_names(roles):
+    conf_names = set()
+    for role in roles:
+        conf_names.add(role['conference_name'])
+    return conf_names
+
+
+def get_newsletter_ids_to_add(
+        conf_names, pilg_newsletters, newsletter_ids_by_conf_name):
+    """Return the ids of conference newsletters the pilgrim is missing."""
+    cur_newsl_ids = set()
+    for pilg_newsletter in pilg_newsletters:
+        cur_newsl_ids.add(pilg_newsletter['newsletter_id'])
+    newsletter_ids = []
+    for conf_name in conf_names:
+        if(conf_name in newsletter_ids_by_conf_name):
+            newsletter_id = newsletter_ids_by_conf_name[conf_name]
+            if(newsletter_id not in cur_newsl_ids):
+                newsletter_ids.append(newsletter_id)
+    return newsletter_ids
@@ -9,6 +9,7 @@ import os
 import base64
 import json
 from dotenv import load_dotenv
+from helpers.accel import json_loads
 
 load_dotenv()
 
@@ -46,23 +47,34 @@ async def _fetch_token(session):
     }
     url = f'{DIRECTORY_ROOL_URL}/auth/token'
     response = await session.post(url, json=payload)
-    data = await response.json()
+    data = await response.json(loads=json_loads)
     DIRECTORY_COOKIES[CI_COOKIE] = data['token']
 
 
 def _check_token(session):
     global fetch_token_task
-    if(fetch_token_task):
+    if(fetch_token_task and not (
+            fetch_token_task.done() and fetch_token_task.exception())):
         return fetch_token_task
     fetch_token_task = asyncio.create_task(_fetch_token(session))
     return fetch_token_task
 
 
+def _expire_token(token_task):
+    # only the first caller rejected with a given token resets it, so
+    # concurrent 401s share a single new token
+    global fetch_token_task
+    if(fetch_token_task is token_task):
+        fetch_token_task = False
+
+
 CONTENT_TYPE = 'CONTENT-TYPE'
+UNAUTHORIZED = 401
 
 
-async def do_call(session, method, url, **kwargs):
-    await _check_token(session)
+async def do_call(session, method, url, retry_unauthorized=True, **kwargs):
+    token_task = _check_token(session)
+    await token_task
     async with session.request(
             method,
             url,
@@ -73,9 +85,15 @@ async def do_call(session, method, url, **kwargs):
             if(CONTENT_TYPE in resp.headers):
                 content_type = resp.headers[CONTENT_TYPE]
                 if(content_type.startswith('application/json')):
-                    return await resp.json()
+                    return await resp.json(loads=json_loads)
                 else:
                     raise Exception(f'Unknown content type: {content_type}')
+            return None
+        elif(resp.status == UNAUTHORIZED and retry_unauthorized):
+            logger.warning(
+                f'Call to {method} {url} was unauthorized, '
+                'fetching a new token')
+            _expire_token(token_task)
         else:
             body = await resp.text()
             logger.error(
@@ -84,6 +102,8 @@ async def do_call(session, method, url, **kwargs):
                 f'Body={body}'
             )
             resp.raise_for_status()
+    return await do_call(
+        session, method, url, retry_unauthorized=False, **kwargs)
 
 
 async def get_auth(session):
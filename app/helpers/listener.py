@@ -0,0 +1,129 @@
+import asyncio
+import ipaddress
+import logging
+import os
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LISTEN_HOST = os.getenv('LISTEN_HOST', '127.0.0.1')
+LISTEN_PORT = int(os.getenv('LISTEN_PORT', '8080'))
+LISTEN_TOKEN = os.getenv('LISTEN_TOKEN')
+DEBOUNCE_SECONDS = float(os.getenv('DEBOUNCE_SECONDS', '5'))
+DEBOUNCE_MAX_WAIT_SECONDS = float(os.getenv('DEBOUNCE_MAX_WAIT_SECONDS', '30'))
+DEBOUNCE_MAX_BATCH = int(os.getenv('DEBOUNCE_MAX_BATCH', '100'))
+NOTIFY_PATH = '/notify'
+
+
+class Debouncer(object):
+    """Coalesces pilgrim id notifications into micro-batches.
+
+    A batch is flushed once no new ids have arrived for debounce_seconds,
+    once max_batch distinct ids are pending, or once the oldest pending id
+    has waited max_wait_seconds, whichever comes first. Repeat
+    notifications for a pending id are folded into the same batch."""
+
+    def __init__(
+            self,
+            on_batch,
+            debounce_seconds=DEBOUNCE_SECONDS,
+            max_wait_seconds=DEBOUNCE_MAX_WAIT_SECONDS,
+            max_batch=DEBOUNCE_MAX_BATCH):
+        self.on_batch = on_batch
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.max_batch = max_batch
+        # dict keeps insertion order, so it doubles as an ordered set
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+
+    def notify(self, pilgrim_ids):
+        """Queue pilgrim ids, normalised to str so 12 and "12" coalesce."""
+        for pilgrim_id in pilgrim_ids:
+            self.pending[str(pilgrim_id)] = True
+        self.wakeup.set()
+
+    async def _wait_for_quiet(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_seconds
+        while len(self.pending) < self.max_batch:
+            timeout = min(self.debounce_seconds, deadline - loop.time())
+            if(timeout <= 0):
+                return
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+                self.wakeup.clear()
+            except asyncio.TimeoutError:
+                return
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await self._wait_for_quiet()
+            batch = list(self.pending)[:self.max_batch]
+            for pilgrim_id in batch:
+                del self.pending[pilgrim_id]
+            if(len(self.pending)):
+                self.wakeup.set()
+            if(not len(batch)):
+                continue
+            logger.info(f'Flushing batch of {len(batch)} pilgrim id(s)')
+            try:
+                await self.on_batch(batch)
+            except Exception:
+                logger.exception(
+                    'Error occurred while processing notified batch')
+
+
+def is_loopback(host):
+    if(host == 'localhost'):
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def is_pilgrim_id(pilgrim_id):
+    # bool is an int subclass but never a valid id
+    return (isinstance(pilgrim_id, (int, str)) and
+            not isinstance(pilgrim_id, bool))
+
+
+async def start_listener(
+        debouncer, host=LISTEN_HOST, port=LISTEN_PORT, token=LISTEN_TOKEN):
+    """Start an HTTP listener that feeds POSTed pilgrim ids to debouncer.
+
+    Expects a JSON body of the form {"pilgrim_ids": [...]}, the same shape
+    as the newsletter-sub-sync queue. Refuses to listen beyond loopback
+    without a token. Returns the runner so the caller can clean it up."""
+    if(not token and not is_loopback(host)):
+        raise Exception(
+            f'Refusing to listen on {host} without LISTEN_TOKEN set')
+
+    async def _notify(request):
+        if(token and
+                request.headers.get('authorization') != f'Bearer {token}'):
+            raise web.HTTPUnauthorized()
+        try:
+            data = await request.json()
+            pilgrim_ids = data['pilgrim_ids']
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest(text='Expected {"pilgrim_ids": [...]}')
+        if(not isinstance(pilgrim_ids, list) or
+                not all(map(is_pilgrim_id, pilgrim_ids))):
+            raise web.HTTPBadRequest(
+                text='pilgrim_ids must be a list of int or str ids')
+        debouncer.notify(pilgrim_ids)
+        logger.info(f'Received notification for {len(pilgrim_ids)} id(s)')
+        return web.json_response(
+            {'queued': len(pilgrim_ids)}, status=202)
+    app = web.Application()
+    app.router.add_post(NOTIFY_PATH, _notify)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f'Listening for notifications on {host}:{port}{NOTIFY_PATH}')
+    return runner
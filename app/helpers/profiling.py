@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from collections import Counter
+from helpers.accel import install_event_loop_policy
+
+logger = logging.getLogger(__name__)
+
+# Start any script with `profile` to sample event-loop lag and gauges and
+# write a flamegraph-compatible CPU profile of the run, or with
+# `debug-loop` to run it in asyncio debug mode with slow callback warnings.
+# Debug mode records a traceback on every call_soon, which would dominate
+# both the CPU profile and the lag, so the two are not combined.
+PROFILE_MODE = 'profile' in sys.argv[1:]
+DEBUG_LOOP_MODE = 'debug-loop' in sys.argv[1:]
+PROFILE_DIR = os.getenv('PROFILE_DIR', '.')
+SLOW_CALLBACK_SECONDS = float(
+    os.getenv('PROFILE_SLOW_CALLBACK_SECONDS', '0.1'))
+LAG_INTERVAL_SECONDS = float(os.getenv('PROFILE_LAG_INTERVAL_SECONDS', '0.1'))
+CPU_INTERVAL_SECONDS = float(
+    os.getenv('PROFILE_CPU_INTERVAL_SECONDS', '0.005'))
+
+GAUGES = {
+    'tasks': lambda: len(asyncio.all_tasks())
+}
+
+
+def register_gauge(name, gauge):
+    """Register a zero-argument callable sampled alongside loop lag."""
+    GAUGES[name] = gauge
+
+
+class CpuSampler(object):
+    """Samples the main thread's stack every interval seconds of process
+    CPU time and counts folded stacks, in the `frame;frame;frame count`
+    format read by flamegraph.pl and speedscope.
+
+    The ITIMER_PROF timer only advances while the process uses CPU, so
+    time spent waiting for I/O is not sampled, and the SIGPROF handler
+    runs on the main thread itself, so it does not depend on another
+    thread getting the GIL."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f'{code.co_name} '
+                f'({os.path.basename(code.co_filename)}:'
+                f'{code.co_firstlineno})')
+            frame = frame.f_back
+        if(len(stack)):
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+async def _sample_loop(lags, gauge_samples):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL_SECONDS)
+        lags.append(max(0.0, loop.time() - started - LAG_INTERVAL_SECONDS))
+        for name, gauge in GAUGES.items():
+            gauge_samples.setdefault(name, []).append(gauge())
+
+
+def _summarize(samples):
+    if(not len(samples)):
+        return {}
+    ordered = sorted(samples)
+    return {
+        'samples': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p95': ordered[int(0.95 * (len(ordered) - 1))],
+        'max': ordered[-1],
+        'last': samples[-1]
+    }
+
+
+def _get_script_name():
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+
+async def _debugged(main):
+    loop = asyncio.get_running_loop()
+    loop.slow_callback_duration = SLOW_CALLBACK_SECONDS
+    # a task of its own, so slow callback warnings name the script
+    return await asyncio.create_task(main, name=_get_script_name())
+
+
+async def _profiled(main):
+    script = _get_script_name()
+    base_path = os.path.join(
+        PROFILE_DIR, f'{script}-{time.strftime("%Y%m%d-%H%M%S")}')
+    lags = []
+    gauge_samples = {}
+    sampler = CpuSampler(CPU_INTERVAL_SECONDS)
+    sampler.start()
+    monitor_task = asyncio.create_task(_sample_loop(lags, gauge_samples))
+    try:
+        return await main
+    finally:
+        monitor_task.cancel()
+        sampler.stop()
+        sampler.write(f'{base_path}.folded')
+        summary = {
+            'loop_lag_seconds': _summarize(lags),
+            'cpu_samples': sum(sampler.stacks.values()),
+            'gauges': dict(map(
+                lambda item: (item[0], _summarize(item[1])),
+                gauge_samples.items()))
+        }
+        with open(f'{base_path}.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        logger.info(
+            f'Loop lag: {json.dumps(summary["loop_lag_seconds"])}')
+        logger.info(
+            f'Wrote profile to {base_path}.folded and {base_path}.json')
+
+
+def run(main):
+    """Drop-in replacement for asyncio.run that profiles the run when the
+    script is started with `profile`, or runs it in asyncio debug mode when
+    started with `debug-loop`."""
+    install_event_loop_policy()
+    if(DEBUG_LOOP_MODE):
+        if(PROFILE_MODE):
+            logger.warning(
+                'Ignoring `profile` in `debug-loop` mode: debug mode '
+                'overhead would dominate the CPU profile and loop lag')
+        return asyncio.run(_debugged(main), debug=True)
+    if(PROFILE_MODE):
+        return asyncio.run(_profiled(main))
+    return asyncio.run(main)
@@ -0,0 +1,35 @@
+import fcntl
+import logging
+import os
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+RUN_LOCK_DIR = os.getenv('RUN_LOCK_DIR', '/tmp')
+
+
+@contextmanager
+def run_lock(name):
+    """Hold an exclusive, non-blocking file lock for the duration of a run.
+
+    Yields True if the lock was acquired, False if another run holds it.
+    The lock is released by the OS if the process dies, so a crashed run
+    never leaves a stale lock behind."""
+    path = os.path.join(RUN_LOCK_DIR, f'{name}.lock')
+    with open(path, 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.seek(0)
+            logger.warning(
+                f'Run lock {path} is held by pid {lock_file.read().strip()}')
+            yield False
+            return
+        try:
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(str(os.getpid()))
+            lock_file.flush()
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,6 +1,7 @@
 import os
 
 from aiohttp import ClientResponseError
+from helpers.accel import json_loads
 
 SENDERNET_ROOT_URL = 'https://api.sender.net/v2'
 SENDERNET_TOKEN = os.getenv('SENDERNET_TOKEN')
@@ -16,7 +17,7 @@ async def get_subscriber(session, email):
         async with session.get(
                 url,
                 headers=SENDER_HEADERS) as resp:
-            return (await resp.json())['data']
+            return (await resp.json(loads=json_loads))['data']
     except ClientResponseError as error:
         if(error.status == 404):
             return None
@@ -30,7 +31,7 @@ async def get_paginated(session, url):
         async with session.get(
                 url,
                 headers=SENDER_HEADERS) as resp:
-            response = (await resp.json())
+            response = (await resp.json(loads=json_loads))
             results = results + response['data']
             if(response['links']):
                 url = response['links']['next']
@@ -56,7 +57,7 @@ async def create_group(session, title):
             url,
             headers=SENDER_HEADERS,
             json=payload) as resp:
-        response = await resp.json()
+        response = await resp.json(loads=json_loads)
         if(response['success']):
             return response['data']['id']
         else:
@@ -68,7 +69,7 @@ async def delete_group(session, group_id):
     async with session.delete(
             url,
             headers=SENDER_HEADERS) as resp:
-        response = await resp.json()
+        response = await resp.json(loads=json_loads)
         if(not response['success']):
             raise Exception(response['message'])
         return response
@@ -80,7 +81,7 @@ async def update_subscriber(session, email, payload):
             url,
             headers=SENDER_HEADERS,
             json=payload) as resp:
-        response = await resp.json()
+        response = await resp.json(loads=json_loads)
         if(not response['success']):
             raise Exception(response['message'])
         return response
@@ -93,7 +94,7 @@ async def create_subscriber(session, email, payload):
             url,
             headers=SENDER_HEADERS,
             json=payload) as resp:
-        response = await resp.json()
+        response = await resp.json(loads=json_loads)
         if(not response['success']):
             raise Exception(response['message'])
         return response
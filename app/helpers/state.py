@@ -0,0 +1,174 @@
+import json
+import os
+import sqlite3
+import time
+
+# anchored to the app directory so runs from any working directory (cron
+# runs from the user's home) share the same state
+STATE_DB = os.getenv('STATE_DB', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'data',
+    'state.db'))
+DEAD_LETTER_BACKOFF_SECONDS = float(
+    os.getenv('DEAD_LETTER_BACKOFF_SECONDS', '900'))
+DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv('DEAD_LETTER_MAX_ATTEMPTS', '8'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pilgrim_conf_index (
+    pilgrim_id TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    conf_names TEXT NOT NULL,
+    newsletter_ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    pilgrim_id TEXT PRIMARY KEY,
+    email TEXT,
+    error TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    first_failed_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    given_up_at REAL
+);
+'''
+
+
+def open_state(path=STATE_DB):
+    """Open the local state DB, creating any missing tables."""
+    directory = os.path.dirname(path)
+    if(directory):
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    dead_letter_columns = set(map(
+        lambda column: column[1],
+        conn.execute('PRAGMA table_info(dead_letters)')))
+    if('given_up_at' not in dead_letter_columns):
+        conn.execute('ALTER TABLE dead_letters ADD COLUMN given_up_at REAL')
+    return conn
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute(
+        'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+
+def set_meta(conn, key, value):
+    conn.execute(
+        'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+        (key, json.dumps(value)))
+
+
+def get_pilgrim_conf_index(conn):
+    """Return {pilgrim_id: (fingerprint, conf_names, newsletter_ids)}."""
+    index = {}
+    for pilgrim_id, fingerprint, conf_names, newsletter_ids in conn.execute(
+            'SELECT pilgrim_id, fingerprint, conf_names, newsletter_ids '
+            'FROM pilgrim_conf_index'):
+        index[pilgrim_id] = (
+            fingerprint,
+            set(json.loads(conf_names)),
+            set(json.loads(newsletter_ids)))
+    return index
+
+
+def save_pilgrim_conf_index(
+        conn, pilgrim_id, fingerprint, conf_names, newsletter_ids):
+    conn.execute(
+        'INSERT OR REPLACE INTO pilgrim_conf_index '
+        '(pilgrim_id, fingerprint, conf_names, newsletter_ids) '
+        'VALUES (?, ?, ?, ?)',
+        (
+            str(pilgrim_id),
+            fingerprint,
+            json.dumps(sorted(conf_names)),
+            json.dumps(sorted(newsletter_ids, key=str))
+        ))
+
+
+def add_dead_letter(conn, pilgrim_id, email, error):
+    """Record a failed attempt for the pilgrim id and schedule its retry
+    with exponential backoff. A pilgrim that was given up on and is queued
+    again starts over. Returns the number of attempts so far."""
+    now = time.time()
+    row = conn.execute(
+        'SELECT attempts, first_failed_at, given_up_at FROM dead_letters '
+        'WHERE pilgrim_id = ?', (str(pilgrim_id),)).fetchone()
+    if(row and row[2] is None):
+        attempts, first_failed_at = row[0] + 1, row[1]
+    else:
+        attempts, first_failed_at = 1, now
+    conn.execute(
+        'INSERT OR REPLACE INTO dead_letters '
+        '(pilgrim_id, email, error, attempts, first_failed_at, '
+        'next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (
+            str(pilgrim_id),
+            email,
+            error,
+            attempts,
+            first_failed_at,
+            now + DEAD_LETTER_BACKOFF_SECONDS * 2 ** (attempts - 1)
+        ))
+    return attempts
+
+
+def remove_dead_letters(conn, pilgrim_ids):
+    conn.executemany(
+        'DELETE FROM dead_letters WHERE pilgrim_id = ?',
+        map(lambda pilgrim_id: (str(pilgrim_id),), pilgrim_ids))
+
+
+def get_due_dead_letters(conn, limit):
+    """Return up to limit pilgrim ids whose retry is due, oldest first."""
+    return list(map(lambda row: row[0], conn.execute(
+        'SELECT pilgrim_id FROM dead_letters '
+        'WHERE attempts < ? AND next_attempt_at <= ? '
+        'ORDER BY next_attempt_at LIMIT ?',
+        (DEAD_LETTER_MAX_ATTEMPTS, time.time(), limit))))
+
+
+def mark_dead_letters_given_up(conn, pilgrim_ids):
+    conn.executemany(
+        'UPDATE dead_letters SET given_up_at = ? WHERE pilgrim_id = ?',
+        map(lambda pilgrim_id: (time.time(), str(pilgrim_id)), pilgrim_ids))
+
+
+def get_dead_letters(conn):
+    """Return all dead letters as dicts, permanently failed ones first."""
+    cursor = conn.execute(
+        'SELECT pilgrim_id, email, error, attempts, first_failed_at, '
+        'next_attempt_at, given_up_at FROM dead_letters '
+        'ORDER BY attempts DESC, pilgrim_id')
+    columns = list(map(lambda column: column[0], cursor.description))
+    return list(map(lambda row: dict(zip(columns, row)), cursor))
+
+
+def mark_pilgrim_conf_index_stale(conn, pilgrim_ids):
+    """Clear the stored fingerprints so the conference script checks the
+    pilgrims again even after they have left the sync queue."""
+    conn.executemany(
+        "UPDATE pilgrim_conf_index SET fingerprint = '' WHERE pilgrim_id = ?",
+        map(lambda pilgrim_id: (str(pilgrim_id),), pilgrim_ids))
+
+
+def update_pilgrim_conf_index(conn, pilgrim_id, conf_names, newsletter_ids):
+    """Like save_pilgrim_conf_index, for callers without the pilgrim's
+    listing entry: keeps any stored fingerprint, and new rows get an empty
+    one so the conference script checks them once more."""
+    conn.execute(
+        'INSERT INTO pilgrim_conf_index '
+        '(pilgrim_id, fingerprint, conf_names, newsletter_ids) '
+        "VALUES (?, '', ?, ?) "
+        'ON CONFLICT (pilgrim_id) DO UPDATE SET '
+        'conf_names = excluded.conf_names, '
+        'newsletter_ids = excluded.newsletter_ids',
+        (
+            str(pilgrim_id),
+            json.dumps(sorted(conf_names)),
+            json.dumps(sorted(newsletter_ids, key=str))
+        ))
@@ -1,11 +1,18 @@
 from helpers.clientsession import get_client_session
 import logging
-import re
+import os
+import sys
 import json
+import time
+import hashlib
 import asyncio
 from dotenv import load_dotenv
 import helpers.directory as directory
+import helpers.state as state
+import helpers.conferences as conferences
 from helpers.chunker import get_chunks
+from helpers.accel import json_dumps
+from helpers.profiling import run
 
 load_dotenv()
 
@@ -21,65 +28,133 @@ CONFERENCES = {
     EASTERN_CONFERENCE
 }
 
-CONF_NEWSL_REGEX = r'^(Piedmont|Western|Eastern) Conference$'
+# Only new pilgrims, pilgrims in the sync queue and pilgrims whose listing
+# entry changed are checked, unless a full sweep is requested with
+# `full-sweep`, is due, or the conference newsletters themselves changed.
+# sync_subscriptions may clear queued ids before this script sees them, so
+# it marks them stale in the local index first (see
+# state.mark_pilgrim_conf_index_stale) and they are still checked here.
+# A pilgrim queued again while this script is processing them can lose the
+# mark when the result is saved; the periodic full sweep catches those.
+# Checked pilgrims whose conference newsletters are all in the index are
+# not looked up again; full sweeps ignore the index and check everyone.
+FULL_SWEEP_MODE = 'full-sweep' in sys.argv[1:]
+FULL_SWEEP_SECONDS = float(os.getenv('FULL_SWEEP_SECONDS', '86400'))
+LAST_FULL_SWEEP_KEY = 'conf_newsletters.last_full_sweep'
+NEWSL_IDS_BY_CONF_KEY = 'conf_newsletters.newsletter_ids_by_conf_name'
+
+
+def get_fingerprint(pilgrim):
+    return hashlib.sha1(
+        json.dumps(pilgrim, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_full_sweep(conn, newsletter_ids_by_conf_name):
+    if(FULL_SWEEP_MODE):
+        logger.info('Full sweep requested')
+        return True
+    if(state.get_meta(conn, NEWSL_IDS_BY_CONF_KEY) !=
+            newsletter_ids_by_conf_name):
+        logger.info('Conference newsletters changed, doing a full sweep')
+        return True
+    last_full_sweep = state.get_meta(conn, LAST_FULL_SWEEP_KEY, 0)
+    if(time.time() - last_full_sweep >= FULL_SWEEP_SECONDS):
+        logger.info('Periodic full sweep is due')
+        return True
+    return False
+
+
+def get_changed_pilgrims(pilgrims, index, pilgrim_ids_to_sync):
+    changed_pilgrims = []
+    for pilgrim in pilgrims:
+        pilgrim_id = str(pilgrim['pilgrim_id'])
+        if(pilgrim_id not in index or
+                pilgrim_id in pilgrim_ids_to_sync or
+                index[pilgrim_id][0] != get_fingerprint(pilgrim)):
+            changed_pilgrims.append(pilgrim)
+    return changed_pilgrims
 
 
 async def update_pilgim_conf_subscriptions(
-        session, pilgrim, newsletter_ids_by_conf_name):
+        session, pilgrim, newsletter_ids_by_conf_name, indexed=None):
+    """Add the pilgrim to the newsletters of their conferences.
+
+    indexed is the pilgrim's (fingerprint, conf_names, newsletter_ids)
+    entry from the local index, if any; when it already has all of their
+    conference newsletters, the pilgrim's newsletters are not fetched.
+    Returns the result message along with the pilgrim's conference names
+    and newsletter ids after the update, for the local index."""
     pilgrim_id = pilgrim['pilgrim_id']
+    logger.info(f'Fetching roles for pilgrim id {pilgrim_id}...')
+    roles = await directory.get_pilgrim_roles(session, pilgrim_id)
+    conf_names = conferences.get_conf_names(roles)
     logger.info(
-        f'Fetching roles and newsletters for pilgrim id {pilgrim_id}...')
-    roles, pilg_newsletters = await asyncio.gather(
-        directory.get_pilgrim_roles(session, pilgrim_id),
-        directory.get_pilgrim_newsletters(session, pilgrim_id)
-    )
+        f'Fetched {len(roles)} role(s) for pilgrim id {pilgrim_id}')
+    if(indexed):
+        _, indexed_conf_names, indexed_newsl_ids = indexed
+        new_conf_names = conf_names - indexed_conf_names
+        if(len(new_conf_names)):
+            logger.info(
+                f'Pilgrim id {pilgrim_id} joined conference(s): ' +
+                json_dumps(sorted(new_conf_names)))
+        missing_newsl_ids = conferences.get_newsletter_ids_to_add(
+            conf_names,
+            map(lambda newsletter_id: {'newsletter_id': newsletter_id},
+                indexed_newsl_ids),
+            newsletter_ids_by_conf_name)
+        if(not len(missing_newsl_ids)):
+            result = (
+                f'Skipping pilgrim id {pilgrim_id}, already in their '
+                'conference newsletters')
+            return result, conf_names, indexed_newsl_ids
+    logger.info(f'Fetching newsletters for pilgrim id {pilgrim_id}...')
+    pilg_newsletters = await directory.get_pilgrim_newsletters(
+        session, pilgrim_id)
     logger.info(
-        f'Fetched {len(roles)} role(s) and ' +
-        f'{len(pilg_newsletters)} newsletter(s) for ' +
-        f'pilgrim id {pilgrim_id}...')
-    conf_names = set()
-    for role in roles:
-        conf_names.add(role['conference_name'])
-    cur_newsl_ids = set()
-    for pilg_newsletter in pilg_newsletters:
-        cur_newsl_ids.add(pilg_newsletter['newsletter_id'])
-    newsletter_ids = []
-    for conf_name in conf_names:
-        if(conf_name in newsletter_ids_by_conf_name):
-            newsletter_id = newsletter_ids_by_conf_name[conf_name]
-            if(newsletter_id not in cur_newsl_ids):
-                newsletter_ids.append(newsletter_id)
+        f'Fetched {len(pilg_newsletters)} newsletter(s) for ' +
+        f'pilgrim id {pilgrim_id}')
+    newsletter_ids = conferences.get_newsletter_ids_to_add(
+        conf_names, pilg_newsletters, newsletter_ids_by_conf_name)
     if(len(newsletter_ids)):
         logger.info((
             f'Adding pilgrim id {pilgrim_id} to newsletters: ' +
-            json.dumps(newsletter_ids)
+            json_dumps(newsletter_ids)
         ))
         await directory.add_pilgrim_newsletters(
             session, pilgrim_id, newsletter_ids)
-        return (
+        result = (
             f'Added pilgrim id {pilgrim_id} to newsletters: ' +
-            json.dumps(newsletter_ids)
+            json_dumps(newsletter_ids)
         )
     else:
-        return f'Skipping pilgrim id {pilgrim_id}, no newsletters to add'
+        result = f'Skipping pilgrim id {pilgrim_id}, no newsletters to add'
+    cur_newsl_ids = set(map(
+        lambda pilg_newsletter: pilg_newsletter['newsletter_id'],
+        pilg_newsletters))
+    return result, conf_names, cur_newsl_ids.union(newsletter_ids)
 
 
 async def main():
+    conn = state.open_state()
     async with get_client_session() as session:
-        pilgrims, newsletters = await asyncio.gather(
+        pilgrims, newsletters, pilgrim_ids_to_sync = await asyncio.gather(
             directory.get_pilgrims(session),
-            directory.get_newsletters(session)
+            directory.get_newsletters(session),
+            directory.get_pilgrim_ids_to_sync(session)
         )
         logger.info(
             f'Fetched {len(pilgrims)} pilgrims(s) and ' +
             f'{len(newsletters)} newsletter(s)')
-        newsletter_ids_by_conf_name = {}
-        for newsletter in newsletters:
-            results = re.match(
-                CONF_NEWSL_REGEX, newsletter['newsletter_label'])
-            if(results):
-                newsletter_ids_by_conf_name[results.group(1)] = \
-                    newsletter['newsletter_id']
+        newsletter_ids_by_conf_name = \
+            conferences.get_newsletter_ids_by_conf_name(newsletters)
+        full_sweep = is_full_sweep(conn, newsletter_ids_by_conf_name)
+        index = {} if full_sweep else state.get_pilgrim_conf_index(conn)
+        if(not full_sweep):
+            pilgrims = get_changed_pilgrims(
+                pilgrims,
+                index,
+                set(map(str, pilgrim_ids_to_sync['pilgrim_ids'])))
+            logger.info(f'Found {len(pilgrims)} new or changed pilgrim(s)')
         pilgrim_chunks = list(get_chunks(pilgrims, 20))
         for idx, pilgrim_chunk in enumerate(pilgrim_chunks):
             logger.info(
@@ -89,12 +164,29 @@ async def main():
                 tasks.append(
                     asyncio.create_task(
                         update_pilgim_conf_subscriptions(
-                            session, pilgrim, newsletter_ids_by_conf_name)
+                            session,
+                            pilgrim,
+                            newsletter_ids_by_conf_name,
+                            index.get(str(pilgrim['pilgrim_id'])))
                     )
                 )
-            for task in asyncio.as_completed(tasks):
-                result = await task
+            await asyncio.wait(tasks)
+            for pilgrim, task in zip(pilgrim_chunk, tasks):
+                result, conf_names, newsletter_ids = task.result()
                 logger.info(result)
+                state.save_pilgrim_conf_index(
+                    conn,
+                    pilgrim['pilgrim_id'],
+                    get_fingerprint(pilgrim),
+                    conf_names,
+                    newsletter_ids)
+            conn.commit()
+        if(full_sweep):
+            state.set_meta(conn, LAST_FULL_SWEEP_KEY, time.time())
+            state.set_meta(
+                conn, NEWSL_IDS_BY_CONF_KEY, newsletter_ids_by_conf_name)
+            conn.commit()
+    conn.close()
     logger.info('Finished!')
 
-asyncio.run(main())
+run(main())
@@ -4,6 +4,7 @@ import logging
 import asyncio
 from dotenv import load_dotenv
 import helpers.directory as directory
+from helpers.profiling import run
 
 load_dotenv()
 
@@ -87,4 +88,4 @@ async def main():
             logger.info(result)
 
 
-asyncio.run(main())
+run(main())
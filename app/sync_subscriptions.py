@@ -2,13 +2,21 @@ from helpers.init_log import init_log
 import logging
 from helpers.clientsession import get_client_session
 import asyncio
+import math
+import os
 import re
-import json
+import sys
 from dotenv import load_dotenv
-from aiohttp import ClientResponseError
 import helpers.sendernet as sendernet
 import helpers.directory as directory
+import helpers.conferences as conferences
+import helpers.state as state
 from helpers.chunker import get_chunks
+from helpers.accel import json_dumps
+from helpers.runlock import run_lock
+from helpers.budget import RunBudget, get_run_budget
+from helpers.listener import Debouncer, start_listener
+from helpers.profiling import register_gauge, run
 logger = logging.getLogger(__name__)
 
 init_log()
@@ -23,10 +31,36 @@ class Counter(object):
 
 
 class Stats(object):
-    updated = Counter()
-    not_updated = Counter()
-    created = Counter()
-    errors = Counter()
+    def __init__(self):
+        # per instance, so repeated runs in listen mode start from zero
+        self.updated = Counter()
+        self.not_updated = Counter()
+        self.created = Counter()
+        self.errors = Counter()
+        self.deferred = Counter()
+
+
+# Writes are scheduled by priority so the most valuable ones land first
+# when the run budget runs out: new subscribers, then group membership
+# changes, then cosmetic name/field updates.
+PRIORITY_CREATE = 0
+PRIORITY_GROUPS = 1
+PRIORITY_FIELDS = 2
+# Share of the run budget that may be spent fetching and diffing before
+# the remaining time is reserved for writes.
+PLAN_BUDGET_SHARE = 0.5
+# In listen mode, notified ids are synced as they arrive and the sync
+# queue is only polled every RECONCILE_SECONDS to catch missed events.
+LISTEN_MODE = 'listen' in sys.argv[1:]
+RECONCILE_SECONDS = float(os.getenv('RECONCILE_SECONDS', '900'))
+# With `with-conferences`, pilgrims are also added to the newsletters of
+# their conferences (as set_pilgrim_conference_newsletters_dir does) using
+# the roles and newsletters already fetched for the sync.
+CONFERENCES_MODE = 'with-conferences' in sys.argv[1:]
+# Failed pilgrim ids go to the dead letter table in the state DB and are
+# retried with backoff, using at most this share of each run's ids.
+DEAD_LETTER_SHARE = float(os.getenv('DEAD_LETTER_SHARE', '0.1'))
+DEAD_LETTER_MIN_RETRIES = int(os.getenv('DEAD_LETTER_MIN_RETRIES', '5'))
 
 
 def update_payload(payload, fieldname, expected_value, subscriber=None):
@@ -84,8 +118,15 @@ def update_fields(payload, pilgrim, field_name_by_title, subscriber=None):
         payload['fields'] = new_fields
 
 
-async def update_subscriber(
-        stats, session, pilgrim, field_name_by_title):
+def get_update_priority(payload, subscriber):
+    if(not subscriber):
+        return PRIORITY_CREATE
+    if('groups' in payload):
+        return PRIORITY_GROUPS
+    return PRIORITY_FIELDS
+
+
+async def get_subscriber_update(session, pilgrim, field_name_by_title):
     email = pilgrim['email']
     subscriber = await sendernet.get_subscriber(session, email)
     payload = {}
@@ -93,25 +134,27 @@ async def update_subscriber(
     update_payload(payload, 'lastname', pilgrim['last_name'], subscriber)
     update_groups(payload, pilgrim['group_ids'], subscriber)
     update_fields(payload, pilgrim, field_name_by_title, subscriber)
+    return pilgrim, subscriber, payload
+
+
+async def update_subscriber(stats, session, pilgrim, subscriber, payload):
+    email = pilgrim['email']
     result: str
+    error = None
     try:
         if(subscriber):
-            if(len(payload)):
-                await sendernet.update_subscriber(session, email, payload)
-                result = 'updated with ' + json.dumps(payload)
-                stats.updated.increment()
-            else:
-                result = 'not updated'
-                stats.not_updated.increment()
+            await sendernet.update_subscriber(session, email, payload)
+            result = 'updated with ' + json_dumps(payload)
+            stats.updated.increment()
         else:
             await sendernet.create_subscriber(session, email, payload)
-            result = 'created with ' + json.dumps(payload)
+            result = 'created with ' + json_dumps(payload)
             stats.created.increment()
-    except ClientResponseError as error:
+    except Exception as exception:
         logger.exception(f'Error occurred while processing email "{email}"')
-        stats.errors.increment()
+        error = exception
         result = 'error: ' + repr(error)
-    return pilgrim, result
+    return pilgrim, result, error
 
 
 async def populate_pilgrim_roles(session, pilgrim):
@@ -133,14 +176,103 @@ async def populate_pilgrim_newsletters(session, pilgrim):
         len(pilgrim['newsletters']))
 
 
-async def populate_additional_pilgrim_data(session, pilgrim):
+async def add_conf_newsletters(
+        session, pilgrim, newsletter_ids_by_conf_name, newsletters_by_id):
+    pilgrim_id = pilgrim['pilgrim_id']
+    newsletter_ids = conferences.get_newsletter_ids_to_add(
+        conferences.get_conf_names(pilgrim['roles']),
+        pilgrim['newsletters'],
+        newsletter_ids_by_conf_name)
+    if(len(newsletter_ids)):
+        logger.info(
+            'Adding pilgrim id %s to newsletters: %s',
+            pilgrim_id,
+            newsletter_ids)
+        await directory.add_pilgrim_newsletters(
+            session, pilgrim_id, newsletter_ids)
+        pilgrim['newsletters'] = pilgrim['newsletters'] + list(map(
+            lambda newsletter_id: newsletters_by_id[newsletter_id],
+            newsletter_ids))
+
+
+async def populate_additional_pilgrim_data(
+        session,
+        pilgrim,
+        newsletter_ids_by_conf_name=None,
+        newsletters_by_id=None):
     await asyncio.gather(
         populate_pilgrim_roles(session, pilgrim),
         populate_pilgrim_newsletters(session, pilgrim)
     )
+    if(newsletter_ids_by_conf_name is not None):
+        await add_conf_newsletters(
+            session, pilgrim, newsletter_ids_by_conf_name, newsletters_by_id)
     return pilgrim
 
 
+async def apply_conf_newsletters(
+        session, pilgrim, newsletter_ids_by_conf_name, newsletters_by_id):
+    """Only add conference newsletters, for pilgrims with no email or whose
+    subscriber is synced from another pilgrim with the same email.
+
+    Returns the pilgrim and the error that stopped it, if any."""
+    try:
+        await populate_additional_pilgrim_data(
+            session, pilgrim, newsletter_ids_by_conf_name, newsletters_by_id)
+        return pilgrim, None
+    except Exception as error:
+        logger.exception(
+            f'Error occurred while adding conference newsletters for '
+            f'pilgrim id {pilgrim["pilgrim_id"]}')
+        return pilgrim, error
+
+
+def save_conf_index(conn, pilgrim):
+    # keeps set_pilgrim_conference_newsletters_dir's index current for the
+    # pilgrims handled in with-conferences mode
+    state.update_pilgrim_conf_index(
+        conn,
+        pilgrim['pilgrim_id'],
+        conferences.get_conf_names(pilgrim['roles']),
+        map(
+            lambda newsletter: newsletter['newsletter_id'],
+            pilgrim['newsletters']))
+    conn.commit()
+
+
+async def plan_subscriber_update(
+        session,
+        pilgrim,
+        field_name_by_title,
+        newsletter_group_ids_by_title,
+        newsletter_ids_by_conf_name=None,
+        newsletters_by_id=None):
+    """Fetch the pilgrim's data and subscriber and build the update.
+
+    Returns the pilgrim, subscriber, payload and the error that stopped
+    it, if any, so that one failing record does not abort the run."""
+    try:
+        await populate_additional_pilgrim_data(
+            session, pilgrim, newsletter_ids_by_conf_name, newsletters_by_id)
+        pilgrim['group_ids'] = set()
+        for newsletter in pilgrim['newsletters']:
+            title = newsletter['newsletter_label']
+            group_id = newsletter_group_ids_by_title[title]
+            pilgrim['group_ids'].add(group_id)
+        logger.info(
+            'Found %s newsletter groups for pilgrim id %s',
+            len(pilgrim['group_ids']),
+            pilgrim['pilgrim_id'])
+        pilgrim, subscriber, payload = await get_subscriber_update(
+            session, pilgrim, field_name_by_title)
+        return pilgrim, subscriber, payload, None
+    except Exception as error:
+        logger.exception(
+            f'Error occurred while fetching data for '
+            f'email "{pilgrim["email"]}"')
+        return pilgrim, None, None, error
+
+
 async def get_field_name_by_title(session):
     fields = await sendernet.get_fields(session)
     field_name_by_title = {}
@@ -177,22 +309,95 @@ async def get_newsletter_group_ids_by_title(session, newsletters, groups):
     return newsletter_group_ids_by_title
 
 
+async def get_pilgrim(session, pilgrim_id):
+    try:
+        pilgrim = await directory.get_pilgrim(session, pilgrim_id)
+        return pilgrim_id, pilgrim, None
+    except Exception as error:
+        logger.exception(
+            f'Error occurred while fetching pilgrim id {pilgrim_id}')
+        return pilgrim_id, None, error
+
+
 async def get_pilgrims(session, pilgrim_ids):
+    """Returns the fetched pilgrims and the errors by pilgrim id for the
+    ones that could not be fetched."""
     logger.info('Fetching pilgrim information to sync...')
     pilgrims = []
+    errors_by_pilgrim_id = {}
     tasks = []
     for pilgrim_id in pilgrim_ids:
         tasks.append(
             asyncio.create_task(
-                directory.get_pilgrim(session, pilgrim_id)
+                get_pilgrim(session, pilgrim_id)
             )
         )
     for task in asyncio.as_completed(tasks):
-        pilgrims.append(await task)
-    return pilgrims
+        pilgrim_id, pilgrim, error = await task
+        if(error):
+            errors_by_pilgrim_id[pilgrim_id] = error
+        else:
+            pilgrims.append(pilgrim)
+    return pilgrims, errors_by_pilgrim_id
+
+
+def has_email(pilgrim):
+    return pilgrim['email'] and pilgrim['email'].strip()
+
+
+def get_pilgrim_ids(pilgrims):
+    return set(map(lambda pilgrim: str(pilgrim['pilgrim_id']), pilgrims))
 
 
-async def do_updates(session, pilgrim_ids):
+def report_dead_letters(conn):
+    dead_letters = state.get_dead_letters(conn)
+    failed = list(filter(
+        lambda dead_letter:
+            dead_letter['attempts'] >= state.DEAD_LETTER_MAX_ATTEMPTS,
+        dead_letters))
+    # permanently failed rows are kept until the pilgrim syncs, but each
+    # one is only reported in the run that gave up on it
+    newly_failed = list(filter(
+        lambda dead_letter: dead_letter['given_up_at'] is None,
+        failed))
+    logger.info(
+        'Dead letters: %s awaiting retry, %s permanently failed (%s new)',
+        len(dead_letters) - len(failed),
+        len(failed),
+        len(newly_failed))
+    for dead_letter in newly_failed:
+        logger.error(
+            'Permanently failed pilgrim id %s (%s) after %s attempts: %s',
+            dead_letter['pilgrim_id'],
+            dead_letter['email'],
+            dead_letter['attempts'],
+            dead_letter['error'])
+    state.mark_dead_letters_given_up(
+        conn,
+        map(lambda dead_letter: dead_letter['pilgrim_id'], newly_failed))
+    conn.commit()
+
+
+async def do_updates(
+        session, conn, pilgrim_ids, budget, retry_pilgrim_ids=()):
+    """Sync the given pilgrim ids to Sender.net within the run budget.
+
+    Dead letters being retried are planned and written after all fresh
+    ids, so they only use what is left of the budget.
+
+    Returns the ids (as strings) that were fully processed or moved to the
+    dead letter table; anything else was deferred by the budget and should
+    be left in the sync queue."""
+    stats = Stats()
+    dead_lettered_pilgrim_ids = set()
+
+    def _dead_letter(pilgrim_id, email, error):
+        stats.errors.increment()
+        dead_lettered_pilgrim_ids.add(str(pilgrim_id))
+        state.add_dead_letter(conn, pilgrim_id, email, repr(error))
+        # commit right away so no write lock is held across the awaits that
+        # follow, which would lock out other scripts using the state DB
+        conn.commit()
     newsletters, groups = await asyncio.gather(
         directory.get_newsletters(session),
         sendernet.get_groups(session)
@@ -202,16 +407,35 @@ async def do_updates(session, pilgrim_ids):
             session, newsletters, groups)
     logger.info(
         f'Found {len(newsletter_group_ids_by_title)} newsletter groups!')
+    newsletter_ids_by_conf_name = None
+    newsletters_by_id = {}
+    if(CONFERENCES_MODE):
+        newsletter_ids_by_conf_name = \
+            conferences.get_newsletter_ids_by_conf_name(newsletters)
+        for newsletter in newsletters:
+            newsletters_by_id[newsletter['newsletter_id']] = newsletter
+        logger.info(
+            f'Found {len(newsletter_ids_by_conf_name)} '
+            'conference newsletters!')
     # fetch fields
     field_name_by_title = await get_field_name_by_title(session)
     logger.info(f'Found {len(field_name_by_title)} fields!')
-    pilgrims = await get_pilgrims(session, pilgrim_ids)
-    logger.info(f'Found {len(pilgrims)} pilgrims!')
-    pilgrims = list(
-        filter(
-            lambda pilgrim: pilgrim['email'] and pilgrim['email'].strip(),
-            pilgrims))
+    retry_pilgrim_ids = set(map(str, retry_pilgrim_ids))
+
+    def _is_retry(pilgrim):
+        return str(pilgrim['pilgrim_id']) in retry_pilgrim_ids
+    all_pilgrims, errors_by_pilgrim_id = \
+        await get_pilgrims(
+            session, list(pilgrim_ids) + list(retry_pilgrim_ids))
+    for pilgrim_id, error in errors_by_pilgrim_id.items():
+        _dead_letter(pilgrim_id, None, error)
+    logger.info(f'Found {len(all_pilgrims)} pilgrims!')
+    pilgrims = list(filter(has_email, all_pilgrims))
     logger.info(f'Found {len(pilgrims)} pilgrims with email addresses!')
+    # pilgrims without an email have nothing to sync
+    synced_pilgrim_ids = \
+        get_pilgrim_ids(all_pilgrims) - get_pilgrim_ids(pilgrims)
+    synced_pilgrim_ids.update(dead_lettered_pilgrim_ids)
     pilgrims_by_email = {}
     for pilgrim in pilgrims:
         email = pilgrim['email'].lower().strip()
@@ -220,63 +444,234 @@ async def do_updates(session, pilgrim_ids):
             [] if email not in pilgrims_by_email \
             else pilgrims_by_email[email]
         pilgrims_by_email[email].append(pilgrim)
+    # the lowest pilgrim id of each email is the one synced to Sender.net
+    for email_pilgrims in pilgrims_by_email.values():
+        email_pilgrims.sort(key=lambda pilgrim: int(pilgrim['pilgrim_id']))
     logger.info(
         f'Found {len(pilgrims_by_email)} pilgrims ' +
         'with distinct email addresses!')
-    stats = Stats()
-    email_chunks = list(get_chunks(list(pilgrims_by_email.keys()), 20))
+    pending_updates = []
+    register_gauge('pending_updates', lambda: len(pending_updates))
+    # stable sort puts emails only known from retries last
+    emails = sorted(
+        pilgrims_by_email.keys(),
+        key=lambda email: _is_retry(pilgrims_by_email[email][0]))
+    email_chunks = list(get_chunks(emails, 20))
     for idx, email_chunk in enumerate(email_chunks):
+        if(budget.expired(PLAN_BUDGET_SHARE)):
+            deferred = sum(map(len, email_chunks[idx:]))
+            logger.warning(
+                'Run budget exhausted, leaving %s subscriber(s) queued',
+                deferred)
+            for _ in range(deferred):
+                stats.deferred.increment()
+            break
         logger.info(
             f'Processing batch {idx+1} of {len(email_chunks)} batches')
-        populate_pilgrim_data_tasks = []
+        subscriber_update_tasks = []
         for email in email_chunk:
-            pilgrims = pilgrims_by_email[email]
-            pilgrims.sort(key=lambda pilgrim: int(pilgrim['pilgrim_id']))
-            pilgrim = pilgrims[0]
-            populate_pilgrim_data_tasks.append(
+            pilgrim = pilgrims_by_email[email][0]
+            subscriber_update_tasks.append(
                 asyncio.create_task(
-                    populate_additional_pilgrim_data(session, pilgrim)))
+                    plan_subscriber_update(
+                        session,
+                        pilgrim,
+                        field_name_by_title,
+                        newsletter_group_ids_by_title,
+                        newsletter_ids_by_conf_name,
+                        newsletters_by_id)))
+        for task in asyncio.as_completed(subscriber_update_tasks):
+            pilgrim, subscriber, payload, error = await task
+            email_pilgrim_ids = \
+                get_pilgrim_ids(pilgrims_by_email[pilgrim['email']])
+            if(error):
+                _dead_letter(pilgrim['pilgrim_id'], pilgrim['email'], error)
+                synced_pilgrim_ids.update(email_pilgrim_ids)
+                continue
+            if(CONFERENCES_MODE):
+                save_conf_index(conn, pilgrim)
+            if(subscriber and not len(payload)):
+                logger.info(
+                    'Finished processing subscriber "%s" with result "%s"',
+                    pilgrim['email'],
+                    'not updated')
+                stats.not_updated.increment()
+                synced_pilgrim_ids.update(email_pilgrim_ids)
+            else:
+                pending_updates.append((
+                    get_update_priority(payload, subscriber),
+                    pilgrim,
+                    subscriber,
+                    payload))
+    # stable sort keeps the original order within each priority, with
+    # retries after all fresh updates
+    pending_updates.sort(
+        key=lambda update: (_is_retry(update[1]), update[0]))
+    # batches are taken off pending_updates so its gauge shows the writes
+    # still waiting to start
+    num_update_chunks = math.ceil(len(pending_updates) / 20)
+    for idx in range(num_update_chunks):
+        if(budget.expired()):
+            deferred = len(pending_updates)
+            logger.warning(
+                'Run budget exhausted, leaving %s update(s) queued',
+                deferred)
+            for _ in range(deferred):
+                stats.deferred.increment()
+            break
+        logger.info(
+            f'Writing batch {idx+1} of {num_update_chunks} batches')
+        update_chunk = pending_updates[:20]
+        del pending_updates[:20]
         update_subscriber_tasks = []
-        for task in asyncio.as_completed(populate_pilgrim_data_tasks):
-            pilgrim = await task
-            pilgrim['group_ids'] = set()
-            for newsletter in pilgrim['newsletters']:
-                title = newsletter['newsletter_label']
-                group_id = newsletter_group_ids_by_title[title]
-                pilgrim['group_ids'].add(group_id)
-            logger.info(
-                'Found %s newsletter groups for pilgrim id %s',
-                len(pilgrim['group_ids']),
-                pilgrim['pilgrim_id'])
+        for _, pilgrim, subscriber, payload in update_chunk:
             update_subscriber_tasks.append(
                 asyncio.create_task(
                     update_subscriber(
-                        stats, session, pilgrim, field_name_by_title)))
+                        stats, session, pilgrim, subscriber, payload)))
         for task in asyncio.as_completed(update_subscriber_tasks):
-            pilgrim, result = await task
+            pilgrim, result, error = await task
             logger.info(
                 'Finished processing subscriber "%s" with result "%s"',
                 pilgrim['email'],
                 result)
+            if(error):
+                _dead_letter(pilgrim['pilgrim_id'], pilgrim['email'], error)
+            synced_pilgrim_ids.update(
+                get_pilgrim_ids(pilgrims_by_email[pilgrim['email']]))
+    if(CONFERENCES_MODE):
+        # pilgrims with no email and the other pilgrims of each handled
+        # email only need conference newsletters; they go after the
+        # Sender.net writes so they only use what is left of the budget
+        conf_only_pilgrims = list(filter(
+            lambda pilgrim: not has_email(pilgrim), all_pilgrims))
+        for email_pilgrims in pilgrims_by_email.values():
+            if(str(email_pilgrims[0]['pilgrim_id']) in synced_pilgrim_ids):
+                conf_only_pilgrims.extend(email_pilgrims[1:])
+        logger.info(
+            f'Adding conference newsletters for {len(conf_only_pilgrims)} '
+            'pilgrim(s) not synced to Sender.net')
+        conf_only_chunks = list(get_chunks(conf_only_pilgrims, 20))
+        for idx, conf_only_chunk in enumerate(conf_only_chunks):
+            if(budget.expired()):
+                deferred_pilgrims = conf_only_pilgrims[idx * 20:]
+                logger.warning(
+                    'Run budget exhausted, leaving %s pilgrim(s) queued '
+                    'for conference newsletters',
+                    len(deferred_pilgrims))
+                for _ in deferred_pilgrims:
+                    stats.deferred.increment()
+                synced_pilgrim_ids.difference_update(
+                    get_pilgrim_ids(deferred_pilgrims))
+                break
+            conf_only_tasks = []
+            for pilgrim in conf_only_chunk:
+                conf_only_tasks.append(
+                    asyncio.create_task(
+                        apply_conf_newsletters(
+                            session,
+                            pilgrim,
+                            newsletter_ids_by_conf_name,
+                            newsletters_by_id)))
+            for task in asyncio.as_completed(conf_only_tasks):
+                pilgrim, error = await task
+                if(error):
+                    _dead_letter(
+                        pilgrim['pilgrim_id'], pilgrim['email'], error)
+                    synced_pilgrim_ids.add(str(pilgrim['pilgrim_id']))
+                else:
+                    save_conf_index(conn, pilgrim)
     logger.info(
-        "Results: %s created, %s updated, %s no updates, %s errors",
+        "Results: %s created, %s updated, %s no updates, %s errors, "
+        "%s deferred",
         stats.created.value,
         stats.updated.value,
         stats.not_updated.value,
-        stats.errors.value)
+        stats.errors.value,
+        stats.deferred.value)
+    state.remove_dead_letters(
+        conn, synced_pilgrim_ids - dead_lettered_pilgrim_ids)
+    conn.commit()
+    report_dead_letters(conn)
+    return synced_pilgrim_ids
+
+
+async def sync_pilgrim_ids(
+        session, conn, pilgrim_ids, budget, retry_pilgrim_ids=()):
+    queued_pilgrim_ids = set(map(str, pilgrim_ids))
+    retry_pilgrim_ids = list(filter(
+        lambda pilgrim_id: pilgrim_id not in queued_pilgrim_ids,
+        retry_pilgrim_ids))
+    synced_pilgrim_ids = await do_updates(
+        session, conn, pilgrim_ids, budget, retry_pilgrim_ids)
+    pilgrim_ids = list(filter(
+        lambda pilgrim_id: str(pilgrim_id) in synced_pilgrim_ids,
+        pilgrim_ids))
+    logger.info(f'Clearing {len(pilgrim_ids)} pilgrim id(s)...')
+    if(len(pilgrim_ids)):
+        if(not CONFERENCES_MODE):
+            # the conference script relies on the queue too; once the ids
+            # are cleared only the stale index entries tell it to look
+            state.mark_pilgrim_conf_index_stale(conn, pilgrim_ids)
+            conn.commit()
+        await directory.clear_pilgrim_ids_to_sync(session, pilgrim_ids)
+
+
+async def sync_queued(session, conn, budget):
+    pilgrim_ids_to_sync = await directory.get_pilgrim_ids_to_sync(session)
+    pilgrim_ids = pilgrim_ids_to_sync['pilgrim_ids']
+    num_pilgrim_ids = len(pilgrim_ids)
+    logger.info(f'Found {num_pilgrim_ids} pilgrim id(s) to process')
+    retry_pilgrim_ids = state.get_due_dead_letters(
+        conn,
+        max(DEAD_LETTER_MIN_RETRIES,
+            int(DEAD_LETTER_SHARE * num_pilgrim_ids)))
+    logger.info(f'Found {len(retry_pilgrim_ids)} dead letter(s) to retry')
+    if(num_pilgrim_ids or len(retry_pilgrim_ids)):
+        await sync_pilgrim_ids(
+            session, conn, pilgrim_ids, budget, retry_pilgrim_ids)
+
+
+async def listen(session, conn):
+    # batches and reconciliation share the session and must not overlap
+    sync_lock = asyncio.Lock()
+
+    async def _on_batch(pilgrim_ids):
+        async with sync_lock:
+            await sync_pilgrim_ids(session, conn, pilgrim_ids, RunBudget())
+
+    async def _reconcile():
+        while True:
+            async with sync_lock:
+                logger.info('Reconciling with the sync queue...')
+                try:
+                    await sync_queued(session, conn, get_run_budget())
+                except Exception:
+                    logger.exception('Error occurred while reconciling')
+            await asyncio.sleep(RECONCILE_SECONDS)
+
+    debouncer = Debouncer(_on_batch)
+    register_gauge('debouncer_pending', lambda: len(debouncer.pending))
+    runner = await start_listener(debouncer)
+    try:
+        await asyncio.gather(debouncer.run(), _reconcile())
+    finally:
+        await runner.cleanup()
 
 
 async def main():
-    async with get_client_session() as session:
-        pilgrim_ids_to_sync = await directory.get_pilgrim_ids_to_sync(session)
-        pilgrim_ids = pilgrim_ids_to_sync['pilgrim_ids']
-        num_pilgrim_ids = len(pilgrim_ids)
-        logger.info(f'Found {num_pilgrim_ids} pilgrim id(s) to process')
-        if(num_pilgrim_ids):
-            await do_updates(session, pilgrim_ids)
-            logger.info('Clearing pilgrim ids...')
-            await directory.clear_pilgrim_ids_to_sync(session, pilgrim_ids)
-        logger.info('Done')
-
-
-asyncio.run(main())
+    with run_lock('sync_subscriptions') as acquired:
+        if(not acquired):
+            logger.warning('Previous sync run still in progress, skipping')
+            return
+        conn = state.open_state()
+        async with get_client_session() as session:
+            if(LISTEN_MODE):
+                await listen(session, conn)
+            else:
+                await sync_queued(session, conn, get_run_budget())
+            logger.info('Done')
+        conn.close()
+
+
+run(main())
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import sys
+import time
+
+# the benchmark lives outside the deployed app directory but measures its
+# helpers, so make them importable when run as `python bench/bench_json.py`
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import helpers.accel as accel  # noqa: E402
+from helpers.init_log import init_log  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Measures the CPU time spent on JSON per run of NUM_SUBSCRIBERS, using
+# synthetic bodies shaped like the directory and Sender.net responses
+# decoded (and the payloads encoded) for each subscriber in a sync run.
+NUM_SUBSCRIBERS = 10000
+# best of REPEATS runs, to keep scheduling noise out of the comparison
+REPEATS = 5
+
+PILGRIM = {
+    'pilgrim_id': '1234', 'first_name': 'Jane', 'last_name': 'Doe',
+    'email': 'jane.doe@example.com', 'church': 'First Presbyterian Church'
+}
+ROLES = [{
+    'week_id': str(week_id), 'date': '2019-03-14', 'location': 'Camp Hanes',
+    'conference_name': 'Piedmont', 'role_type_guest': str(int(not week_id))
+} for week_id in range(6)]
+NEWSLETTERS = [{
+    'newsletter_id': str(newsletter_id),
+    'newsletter_label': f'Newsletter {newsletter_id}'
+} for newsletter_id in range(4)]
+SUBSCRIBER = {'data': {
+    'id': 'aBcDeF', 'email': 'jane.doe@example.com',
+    'firstname': 'Jane', 'lastname': 'Doe',
+    'subscriber_tags': [
+        {'id': f'g{group_id}', 'title': f'Newsletter {group_id}'}
+        for group_id in range(4)],
+    'columns': [{'title': f'Field {field_id}', 'value': 'x' * 20}
+                for field_id in range(9)]
+}}
+PAYLOAD = {
+    'firstname': 'Jane', 'groups': ['g0', 'g1', 'g2'],
+    'fields': {f'{{$field_{field_id}}}': 'x' * 20 for field_id in range(9)}
+}
+# resp.json(loads=...) decodes the body to str before calling loads
+BODIES = list(map(
+    lambda body: json.dumps(body).encode('utf-8'),
+    [PILGRIM, ROLES, NEWSLETTERS, SUBSCRIBER]))
+
+
+def bench_once(loads, dumps):
+    started = time.process_time()
+    for _ in range(NUM_SUBSCRIBERS):
+        for body in BODIES:
+            loads(body.decode('utf-8'))
+        # request body and result log line
+        dumps(PAYLOAD)
+        dumps(PAYLOAD)
+    return time.process_time() - started
+
+
+def bench(loads, dumps):
+    return min(map(lambda _: bench_once(loads, dumps), range(REPEATS)))
+
+
+def main():
+    init_log()
+    stdlib = bench(json.loads, json.dumps)
+    logger.info(f'json: {stdlib:.3f}s CPU per {NUM_SUBSCRIBERS} subscribers')
+    if(accel.orjson):
+        fast = bench(accel.json_loads, accel.json_dumps)
+        logger.info(
+            f'{accel.JSON_CODEC}: {fast:.3f}s CPU per {NUM_SUBSCRIBERS} '
+            f'subscribers, saving {stdlib - fast:.3f}s '
+            f'({100 * (stdlib - fast) / stdlib:.0f}%)')
+    else:
+        logger.warning('orjson is not installed, see requirements-accel.txt')
+
+
+if __name__ == '__main__':
+    main()